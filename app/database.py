@@ -4,10 +4,13 @@ Database connection and SQL validation utilities
 
 import os
 import psycopg
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool
 from typing import Dict, Any, Optional
 import logging
-import re
+
+from sqlglot import exp
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.errors import SqlglotError
 
 # Load environment variables
 try:
@@ -19,7 +22,30 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 # Database connection pool
-db_pool: Optional[ConnectionPool] = None
+db_pool: Optional[AsyncConnectionPool] = None
+
+# Dialect used to tokenize and parse generated queries
+_POSTGRES = Dialect.get_or_raise("postgres")
+
+# Statement nodes that must never appear anywhere in a generated query
+_FORBIDDEN_NODES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop,
+    exp.Alter, exp.TruncateTable, exp.Grant, exp.Revoke, exp.Copy,
+    exp.Command, exp.Into, exp.Lock
+)
+
+# System catalogs (role password hashes, other sessions' SQL, server settings)
+# are off limits; matched case-insensitively on schema or table name prefix
+_FORBIDDEN_SCHEMAS = frozenset({"pg_catalog", "information_schema"})
+_FORBIDDEN_TABLE_PREFIX = "pg_"
+
+# Functions that can read server files, sleep, signal backends or run
+# arbitrary SQL; matched case-insensitively by prefix or exact name
+_FORBIDDEN_FUNCTION_PREFIXES = ("pg_", "lo_", "dblink")
+_FORBIDDEN_FUNCTIONS = frozenset({
+    "set_config", "current_setting", "query_to_xml", "query_to_xmlschema",
+    "query_to_xml_and_xmlschema", "cursor_to_xml"
+})
 
 
 def get_db_config() -> Dict[str, str]:
@@ -33,8 +59,21 @@ def get_db_config() -> Dict[str, str]:
     }
 
 
-def init_db_pool(min_conn: int = 1, max_conn: int = 10):
-    """Initialize database connection pool"""
+async def init_db_pool(min_conn: Optional[int] = None, max_conn: Optional[int] = None, wait: bool = False):
+    """
+    Initialize and open the database connection pool
+    
+    Pool sizing comes from DB_POOL_MIN / DB_POOL_MAX (default 5/30) unless
+    given explicitly. Connections are recycled after DB_POOL_RECYCLE seconds
+    (default 3600) and idle connections above min size are closed after
+    DB_POOL_MAX_IDLE seconds (default 600), so connections dropped by the
+    server are replaced instead of surfacing as errors.
+    
+    Args:
+        min_conn: Minimum number of connections kept open
+        max_conn: Maximum number of connections
+        wait: Block until min_conn connections are established
+    """
     global db_pool
     
     if db_pool is None:
@@ -42,11 +81,26 @@ def init_db_pool(min_conn: int = 1, max_conn: int = 10):
         try:
             # Build connection string for psycopg3
             conninfo = f"host={config['host']} port={config['port']} dbname={config['database']} user={config['user']} password={config['password']}"
-            db_pool = ConnectionPool(
+            
+            # Session settings sent as startup options, so they cost no extra
+            # round-trip per query: a statement timeout, and read-only
+            # transactions as a database-level guard behind SQL validation
+            statement_timeout_ms = int(os.getenv("DB_STATEMENT_TIMEOUT", "60")) * 1000
+            options = f"-c statement_timeout={statement_timeout_ms} -c default_transaction_read_only=on"
+            
+            db_pool = AsyncConnectionPool(
                 conninfo,
-                min_size=min_conn,
-                max_size=max_conn
+                min_size=min_conn if min_conn is not None else int(os.getenv("DB_POOL_MIN", "5")),
+                max_size=max_conn if max_conn is not None else int(os.getenv("DB_POOL_MAX", "30")),
+                max_lifetime=float(os.getenv("DB_POOL_RECYCLE", "3600")),
+                max_idle=float(os.getenv("DB_POOL_MAX_IDLE", "600")),
+                num_workers=int(os.getenv("DB_POOL_WORKERS", "3")),
+                # Auto-prepare statements on their second execution; repeated
+                # questions (LLM cache hits) then skip server-side parse/plan
+                kwargs={"options": options, "prepare_threshold": 2},
+                open=False
             )
+            await db_pool.open(wait=wait)
             logger.info("Database connection pool initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize database pool: {str(e)}")
@@ -54,17 +108,41 @@ def init_db_pool(min_conn: int = 1, max_conn: int = 10):
     return db_pool
 
 
-def get_db_connection():
-    """Get a database connection from the pool"""
+async def close_db_pool():
+    """Close the database connection pool"""
+    global db_pool
+    
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+        logger.info("Database connection pool closed")
+
+
+async def get_db_pool() -> AsyncConnectionPool:
+    """Get the database connection pool, initializing it if needed"""
     if db_pool is None:
-        init_db_pool()
-    return db_pool.getconn()
+        await init_db_pool()
+    return db_pool
+
+
+async def get_db_connection():
+    """Get a database connection from the pool"""
+    pool = await get_db_pool()
+    return await pool.getconn()
 
 
-def return_db_connection(conn):
+async def return_db_connection(conn):
     """Return a connection to the pool"""
     if conn:
-        conn.close()
+        pool = await get_db_pool()
+        await pool.putconn(conn)
+
+
+def _function_name(func: exp.Func) -> str:
+    """Get the lowercase SQL name of a parsed function call"""
+    if isinstance(func, exp.Anonymous):
+        return func.name.lower()
+    return func.sql_name().lower()
 
 
 def validate_sql_query(sql_query: str) -> Dict[str, Any]:
@@ -74,74 +152,135 @@ def validate_sql_query(sql_query: str) -> Dict[str, Any]:
     Returns:
         dict: {
             "is_valid": bool,
-            "error": str (if invalid)
+            "error": str (if invalid),
+            "statement": parsed sqlglot expression (if valid)
         }
     """
-    if not sql_query or not sql_query.strip():
+    if not sql_query:
         return {"is_valid": False, "error": "Empty SQL query"}
     
-    # Normalize query (remove extra whitespace, convert to uppercase for checking)
-    query_upper = sql_query.upper().strip()
-    
-    # Block dangerous operations
-    dangerous_keywords = [
-        "INSERT", "UPDATE", "DELETE", "DROP", "CREATE", "ALTER",
-        "TRUNCATE", "EXEC", "EXECUTE", "GRANT", "REVOKE"
-    ]
+    # Tokenize once; comments, statement boundaries and the AST all come from
+    # this single pass instead of separate scans over the raw string
+    try:
+        tokens = _POSTGRES.tokenize(sql_query)
+        statements = [
+            statement for statement in _POSTGRES.parser().parse(tokens, sql_query)
+            if statement is not None
+        ]
+    except SqlglotError as e:
+        logger.warning(f"Failed to parse SQL query: {str(e)}")
+        return {
+            "is_valid": False,
+            "error": "Unable to parse SQL query"
+        }
     
-    for keyword in dangerous_keywords:
-        # Use word boundaries to avoid matching substrings
-        pattern = r'\b' + re.escape(keyword) + r'\b'
-        if re.search(pattern, query_upper):
-            return {
-                "is_valid": False,
-                "error": f"Query contains forbidden operation: {keyword}"
-            }
+    if not statements:
+        return {"is_valid": False, "error": "Empty SQL query"}
     
-    # Ensure it starts with SELECT
-    if not query_upper.startswith("SELECT"):
+    # Block comments that might hide malicious code
+    if any(token.comments for token in tokens):
         return {
             "is_valid": False,
-            "error": "Query must be a SELECT statement only"
+            "error": "SQL comments not allowed"
         }
     
     # Block multiple statements (prevent SQL injection via ;)
-    if sql_query.count(';') > 1 or (sql_query.count(';') == 1 and not sql_query.strip().endswith(';')):
+    if len(statements) > 1:
         return {
             "is_valid": False,
             "error": "Multiple statements not allowed"
         }
     
-    # Block comments that might hide malicious code
-    if '--' in sql_query or '/*' in sql_query:
+    statement = statements[0]
+    
+    # Ensure it is a SELECT (or a set operation over SELECTs)
+    if not isinstance(statement, exp.Query):
         return {
             "is_valid": False,
-            "error": "SQL comments not allowed"
+            "error": "Query must be a SELECT statement only"
+        }
+    
+    # Block dangerous operations anywhere in the tree (e.g. data-modifying CTEs)
+    forbidden = statement.find(*_FORBIDDEN_NODES)
+    if forbidden is not None:
+        return {
+            "is_valid": False,
+            "error": f"Query contains forbidden operation: {forbidden.key.upper()}"
         }
     
-    # Additional safety: Check for function calls that modify data
-    dangerous_functions = [
-        "PG_", "COPY_", "IMPORT", "EXPORT"
-    ]
+    # Block reads of system catalog tables and views
+    for table in statement.find_all(exp.Table):
+        if table.db.lower() in _FORBIDDEN_SCHEMAS or table.name.lower().startswith(_FORBIDDEN_TABLE_PREFIX):
+            return {
+                "is_valid": False,
+                "error": f"Access to system table not allowed: {table.sql(dialect='postgres')}"
+            }
     
-    for func in dangerous_functions:
-        if func in query_upper:
+    # Additional safety: Check for function calls with side effects
+    for func in statement.find_all(exp.Func):
+        name = _function_name(func)
+        if name.startswith(_FORBIDDEN_FUNCTION_PREFIXES) or name in _FORBIDDEN_FUNCTIONS:
             return {
                 "is_valid": False,
-                "error": f"Dangerous function call detected"
+                "error": f"Dangerous function call detected: {name}"
             }
     
-    return {"is_valid": True}
+    return {"is_valid": True, "statement": statement}
+
+
+def _literal_row_count(limit: exp.Expression) -> Optional[int]:
+    """Get the row count of a LIMIT/FETCH clause if it is a plain integer literal"""
+    if isinstance(limit, exp.Fetch):
+        options = limit.args.get("limit_options")
+        if options is not None and (options.args.get("percent") or options.args.get("with_ties")):
+            return None
+        count = limit.args.get("count")
+        if count is None:
+            # FETCH FIRST ROW ONLY
+            return 1
+    else:
+        count = limit.expression
+    if isinstance(count, exp.Literal) and count.is_int:
+        return int(count.this)
+    return None
+
+
+def apply_row_limit(sql_query: str, statement: exp.Query, max_rows: int) -> str:
+    """
+    Bound the number of rows a validated query can return.
+    
+    Queries without a top-level LIMIT, or with a literal one above
+    max_rows + 1, get a LIMIT of max_rows + 1 so the executor can still tell
+    when results were truncated. Queries whose LIMIT/FETCH is an expression
+    keep it and are wrapped in an outer bounded SELECT.
+    
+    Args:
+        sql_query: Validated SQL query
+        statement: Parsed statement returned by validate_sql_query
+        max_rows: Maximum number of rows the caller will return
+        
+    Returns:
+        SQL query to execute
+    """
+    row_limit = max_rows + 1
+    limit = statement.args.get("limit")
+    if limit is None:
+        return statement.limit(row_limit).sql(dialect="postgres")
+    
+    count = _literal_row_count(limit)
+    if count is None:
+        return exp.select("*").from_(statement.subquery("q")).limit(row_limit).sql(dialect="postgres")
+    if count <= row_limit:
+        return sql_query
+    return statement.limit(row_limit).sql(dialect="postgres")
 
 
-def test_connection() -> bool:
+async def test_connection() -> bool:
     """Test database connection"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.close()
-        return_db_connection(conn)
+        pool = await get_db_pool()
+        async with pool.connection() as conn:
+            await conn.execute("SELECT 1")
         return True
     except Exception as e:
         logger.error(f"Database connection test failed: {str(e)}")
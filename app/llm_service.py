@@ -1,12 +1,17 @@
 """
 LLM Service for Natural Language to SQL conversion
-Uses LangChain and OpenAI GPT models
+Uses the OpenAI SDK and GPT models
 """
 
 import os
-from typing import Optional, List, Dict, Any
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import re
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple
+from openai import AsyncOpenAI
 import logging
 
 # Load environment variables
@@ -18,32 +23,78 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Opening markdown fence with optional language tag (```sql, ```postgres, ...)
+# followed by a newline, or a sql/postgres tag followed by a space on the same
+# line (```sql SELECT ...), and closing fence, around the model's SQL. A
+# statement keyword right after the fence is SQL, never a language tag
+_FENCE_RE = re.compile(
+    r'^\s*```(?:(?!(?i:select|with)\b)[\w+-]*[ \t]*\r?\n|(?i:sql|postgres(?:ql)?)[ \t]+)?|```\s*$'
+)
+
+_QUESTION_PREFIX = "Question: "
+_QUESTION_SUFFIX = "\n\nGenerate the SQL query:"
+
 
 class LLMService:
     """Service for handling LLM interactions and SQL generation"""
     
-    def __init__(self, model_name: str = "gpt-4o-mini"):
+    def __init__(self, model_name: str = "gpt-4o-mini", cache_size: int = 1024):
         """
         Initialize LLM service
         
         Args:
             model_name: OpenAI model to use (default: gpt-4o-mini for cost efficiency)
+            cache_size: Maximum number of generated SQL queries kept in the LRU cache
         """
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable not set")
         
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0,  # Lower temperature for more deterministic SQL
-            api_key=api_key
-        )
+        self.client = AsyncOpenAI(api_key=api_key)
         self.model_name = model_name
         
         # Database schema for context
         self.schema_context = self._build_schema_context()
         
-        logger.info(f"LLMService initialized with model: {model_name}")
+        # Render the system prompt once so every request sends identical bytes;
+        # OpenAI prompt caching only applies to an exactly repeated prefix
+        self._system_prompt = self._get_system_prompt()
+        self._prompt_hash = hashlib.blake2b(self._system_prompt.encode()).hexdigest()[:16]
+        
+        # Pre-built system message reused by every request
+        self._system_message = {"role": "system", "content": self._system_prompt}
+        
+        # Optional prompt stored on the OpenAI platform holding the system
+        # instructions; when set, real-time requests go through the Responses
+        # API and only upload the question
+        self.prompt_id = os.getenv("OPENAI_PROMPT_ID")
+        self.prompt_version = os.getenv("OPENAI_PROMPT_VERSION")
+        if self.prompt_id:
+            self._stored_prompt = {"id": self.prompt_id}
+            if self.prompt_version:
+                self._stored_prompt["version"] = self.prompt_version
+            # Cached SQL must not outlive a change of stored prompt, so it is
+            # keyed on the pinned version; an unpinned prompt can change on the
+            # dashboard at any time, so its SQL is not cached at all
+            self._prompt_hash = f"{self.prompt_id}:{self.prompt_version}"
+            if not self.prompt_version:
+                logger.warning("OPENAI_PROMPT_VERSION not set; generated SQL will not be cached")
+                cache_size = 0
+        
+        # LRU cache of generated SQL keyed by normalized question
+        self._sql_cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self._sql_cache_size = cache_size
+        self._sql_cache_lock = threading.Lock()
+        
+        # In-flight async generations, so concurrent identical questions share one call
+        self._inflight: Dict[Tuple[str, str, str], "asyncio.Future[Optional[str]]"] = {}
+        
+        logger.info(
+            f"LLMService initialized with model: {model_name}"
+            f"{f', stored prompt: {self.prompt_id}' if self.prompt_id else ''}"
+        )
     
     def _build_schema_context(self) -> str:
         """Build schema context string for prompt"""
@@ -152,9 +203,52 @@ Examples:
     AND r.gender = 'Male';
 """
     
-    def generate_sql(self, question: str) -> Optional[str]:
+    def _cache_key(self, question: str) -> Tuple[str, str, str]:
+        """Build the SQL cache key from model, system prompt and normalized question"""
+        normalized = _WHITESPACE_RE.sub(' ', question.strip().lower())
+        return (self.model_name, self._prompt_hash, normalized)
+    
+    def _cache_get(self, key: Tuple[str, str, str]) -> Optional[str]:
+        """Return cached SQL for key, marking it as recently used"""
+        with self._sql_cache_lock:
+            sql_query = self._sql_cache.get(key)
+            if sql_query is not None:
+                self._sql_cache.move_to_end(key)
+            return sql_query
+    
+    def _cache_put(self, key: Tuple[str, str, str], sql_query: str):
+        """Store generated SQL, evicting the least recently used entry if full"""
+        if self._sql_cache_size <= 0:
+            return
+        with self._sql_cache_lock:
+            self._sql_cache[key] = sql_query
+            self._sql_cache.move_to_end(key)
+            if len(self._sql_cache) > self._sql_cache_size:
+                self._sql_cache.popitem(last=False)
+    
+    def _build_messages(self, question: str) -> List[Dict[str, str]]:
+        """Build the chat messages for a SQL generation request"""
+        return [
+            self._system_message,
+            {"role": "user", "content": f"{_QUESTION_PREFIX}{question}{_QUESTION_SUFFIX}"}
+        ]
+    
+    def _extract_sql(self, content: str) -> str:
+        """Extract the SQL query from raw model output"""
+        # Remove markdown code blocks if present
+        sql_query = _FENCE_RE.sub('', content).strip()
+        
+        # Ensure it ends with semicolon
+        if not sql_query.endswith(';'):
+            sql_query += ';'
+        
+        return sql_query
+    
+    async def generate_sql(self, question: str) -> Optional[str]:
         """
-        Generate SQL query from natural language question
+        Generate SQL query from natural language question.
+        Concurrent requests for the same normalized question share a single
+        in-flight LLM call.
         
         Args:
             question: Natural language question
@@ -162,31 +256,44 @@ Examples:
         Returns:
             SQL query string or None if generation fails
         """
+        cache_key = self._cache_key(question)
+        cached_sql = self._cache_get(cache_key)
+        if cached_sql is not None:
+            logger.info("Returning cached SQL for question")
+            return cached_sql
+        
+        pending = self._inflight.get(cache_key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._request_sql(question, cache_key))
+            self._inflight[cache_key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        else:
+            logger.info("Joining in-flight SQL generation for question")
+        
+        # Shield so one cancelled client doesn't cancel the call for the others
+        return await asyncio.shield(pending)
+    
+    async def _request_sql(self, question: str, cache_key: Tuple[str, str, str]) -> Optional[str]:
+        """Run a single LLM call for generate_sql"""
         try:
-            messages = [
-                SystemMessage(content=self._get_system_prompt()),
-                HumanMessage(content=f"Question: {question}\n\nGenerate the SQL query:")
-            ]
-            
-            response = self.llm.invoke(messages)
-            
-            # Extract SQL from response
-            sql_query = response.content.strip()
-            
-            # Remove markdown code blocks if present
-            if sql_query.startswith("```sql"):
-                sql_query = sql_query[6:]
-            elif sql_query.startswith("```"):
-                sql_query = sql_query[3:]
-            
-            if sql_query.endswith("```"):
-                sql_query = sql_query[:-3]
-            
-            sql_query = sql_query.strip()
-            
-            # Ensure it ends with semicolon
-            if not sql_query.endswith(';'):
-                sql_query += ';'
+            if self.prompt_id:
+                response = await self.client.responses.create(
+                    model=self.model_name,
+                    temperature=0,  # Lower temperature for more deterministic SQL
+                    prompt=self._stored_prompt,
+                    input=f"{_QUESTION_PREFIX}{question}{_QUESTION_SUFFIX}"
+                )
+                content = response.output_text
+            else:
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    temperature=0,  # Lower temperature for more deterministic SQL
+                    messages=self._build_messages(question)
+                )
+                content = response.choices[0].message.content
+            sql_query = self._extract_sql(content or "")
+            self._log_prompt_cache_usage(response.usage)
+            self._cache_put(cache_key, sql_query)
             
             logger.info(f"Generated SQL: {sql_query[:200]}...")
             return sql_query
@@ -195,6 +302,133 @@ Examples:
             logger.error(f"Error generating SQL: {str(e)}", exc_info=True)
             return None
     
+    def _log_prompt_cache_usage(self, usage: Any):
+        """Log how many prompt tokens were served from OpenAI's prompt cache"""
+        if usage is None:
+            return
+        # Chat Completions reports prompt_tokens, the Responses API input_tokens
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", 0)
+        details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        logger.debug(f"Prompt tokens: {prompt_tokens} (cached: {cached_tokens})")
+    
+    async def submit_batch(self, questions: List[str]) -> str:
+        """
+        Submit questions to the OpenAI Batch API (50% cheaper, 24h window)
+        
+        Args:
+            questions: Natural language questions
+            
+        Returns:
+            OpenAI batch ID to poll with get_batch_results
+        """
+        lines = []
+        for index, question in enumerate(questions):
+            lines.append(json.dumps({
+                "custom_id": f"q-{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "temperature": 0,
+                    "messages": self._build_messages(question)
+                }
+            }))
+        
+        input_file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        logger.info(f"Submitted batch {batch.id} with {len(questions)} question(s)")
+        return batch.id
+    
+    async def get_batch_results(self, batch_id: str) -> Dict[str, Any]:
+        """
+        Poll a submitted batch and extract generated SQL once it completes
+        
+        Questions are recovered from the batch input file, so results can be
+        fetched from any worker, including after a restart.
+        
+        Args:
+            batch_id: ID returned by submit_batch
+            
+        Returns:
+            dict: {
+                "status": str,
+                "items": List[dict] with question, sql_query and error
+                         (empty until the batch is completed)
+            }
+        """
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return {"status": batch.status, "items": []}
+        
+        questions = {}
+        cacheable = set()
+        input_content = await self.client.files.content(batch.input_file_id)
+        for line in input_content.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            
+            # Skip entries not created by submit_batch (any batch ID on the account can be polled)
+            body = entry.get("body") or {}
+            messages = body.get("messages") or []
+            if (
+                not str(entry.get("custom_id", "")).startswith("q-")
+                or entry.get("url") != "/v1/chat/completions"
+                or len(messages) != 2
+            ):
+                continue
+            
+            prompt = messages[-1].get("content") or ""
+            if not (prompt.startswith(_QUESTION_PREFIX) and prompt.endswith(_QUESTION_SUFFIX)):
+                continue
+            questions[entry["custom_id"]] = prompt[len(_QUESTION_PREFIX):-len(_QUESTION_SUFFIX)]
+            
+            # Only cache SQL generated with the same model and prompt the live path uses
+            if (
+                not self.prompt_id
+                and body.get("model") == self.model_name
+                and messages[0].get("content") == self._system_prompt
+            ):
+                cacheable.add(entry["custom_id"])
+        
+        generated = {}
+        if batch.output_file_id:
+            output_content = await self.client.files.content(batch.output_file_id)
+            for line in output_content.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get("custom_id") not in questions:
+                    continue
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200:
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    # A null content (e.g. a refusal) leaves the item failed
+                    if content:
+                        generated[entry["custom_id"]] = self._extract_sql(content)
+        
+        items = []
+        for custom_id, question in questions.items():
+            sql_query = generated.get(custom_id)
+            if sql_query is not None and custom_id in cacheable:
+                self._cache_put(self._cache_key(question), sql_query)
+            items.append({
+                "question": question,
+                "sql_query": sql_query,
+                "error": None if sql_query is not None else "SQL generation failed in batch"
+            })
+        
+        return {"status": batch.status, "items": items}
+    
     def format_answer(self, question: str, sql_query: str, data: List[Dict[str, Any]], row_count: int) -> str:
         """
         Format the query results into a natural language answer
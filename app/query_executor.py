@@ -2,11 +2,15 @@
 Query executor for safely executing SQL queries and returning results
 """
 
+import os
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import logging
 
-from app.database import get_db_connection, return_db_connection
+from psycopg.rows import dict_row
+
+from app.database import get_db_pool
+from app.result_cache import ResultCache
 
 logger = logging.getLogger(__name__)
 
@@ -14,75 +18,119 @@ logger = logging.getLogger(__name__)
 class QueryExecutor:
     """Service for executing SQL queries safely"""
     
-    def __init__(self, max_execution_time: int = 60):
+    def __init__(
+        self,
+        max_rows: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        result_cache: Optional[ResultCache] = None
+    ):
         """
         Initialize query executor
         
+        The statement timeout (DB_STATEMENT_TIMEOUT) and read-only mode are set
+        on each pooled connection, see init_db_pool.
+        
         Args:
-            max_execution_time: Maximum query execution time in seconds
+            max_rows: Maximum number of rows fetched per query
+                      (default: QUERY_MAX_ROWS env var or 1000)
+            max_cost: Maximum planner cost estimate allowed before execution;
+                      0 disables the check (default: QUERY_MAX_COST env var or 1e7)
+            result_cache: Cache for successful results (default: configured from env)
         """
-        self.max_execution_time = max_execution_time
-        logger.info(f"QueryExecutor initialized with max execution time: {max_execution_time}s")
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv("QUERY_MAX_ROWS", "1000"))
+        self.max_cost = max_cost if max_cost is not None else float(os.getenv("QUERY_MAX_COST", "1e7"))
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        logger.info(f"QueryExecutor initialized with max rows: {self.max_rows}, max cost: {self.max_cost:,.0f}")
+    
+    async def _estimate_cost(self, conn, sql_query: str) -> float:
+        """Get the planner's total cost estimate for a query without running it"""
+        cursor = await conn.execute("EXPLAIN (FORMAT JSON) " + sql_query)
+        row = await cursor.fetchone()
+        return float(row[0][0]["Plan"]["Total Cost"])
     
-    def execute_query(self, sql_query: str) -> Dict[str, Any]:
+    async def execute_query(self, sql_query: str, use_cache: bool = True) -> Dict[str, Any]:
         """
         Execute SQL query and return results
         
         Args:
             sql_query: SQL query to execute
+            use_cache: Serve a recent cached result if available
             
         Returns:
             dict: {
                 "success": bool,
                 "data": List[Dict[str, Any]],
+                "truncated": bool (more than max_rows rows were available),
                 "execution_time_ms": float,
-                "error": str (if failed)
+                "error": str (if failed),
+                "error_code": "query_too_expensive" if rejected by the cost check
             }
         """
-        conn = None
         start_time = time.time()
         
+        if use_cache:
+            cached_result = await self.result_cache.get(sql_query)
+            if cached_result is not None:
+                cached_result["execution_time_ms"] = (time.time() - start_time) * 1000
+                logger.info(f"Returning cached result. Rows: {len(cached_result['data'])}")
+                return cached_result
+        
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Set statement timeout
-            cursor.execute(f"SET statement_timeout = {self.max_execution_time * 1000};")
-            
-            # Execute query
-            cursor.execute(sql_query)
+            # The pool context returns the connection (and ends its
+            # transaction) on both success and error
+            pool = await get_db_pool()
+            async with pool.connection() as conn:
+                # Reject queries the planner expects to be very expensive (e.g.
+                # sequential scans of the largest tables) instead of letting
+                # them run until the statement timeout
+                if self.max_cost > 0:
+                    cost = await self._estimate_cost(conn, sql_query)
+                    if cost > self.max_cost:
+                        execution_time = (time.time() - start_time) * 1000
+                        logger.warning(f"Query rejected: estimated cost {cost:,.0f} exceeds {self.max_cost:,.0f}")
+                        return {
+                            "success": False,
+                            "data": [],
+                            "truncated": False,
+                            "execution_time_ms": execution_time,
+                            "error": (
+                                f"Query is too expensive to run (estimated cost {cost:,.0f}). "
+                                "Please narrow it down, e.g. by date range, lab or test."
+                            ),
+                            "error_code": "query_too_expensive"
+                        }
+                
+                # Results are bounded by apply_row_limit, so a client-side cursor
+                # is used: unlike a server-side one it can run as a prepared
+                # statement. Binary protocol skips text parsing of values and
+                # dict_row builds the row dictionaries inside psycopg
+                async with conn.cursor(binary=True, row_factory=dict_row) as cursor:
+                    await cursor.execute(sql_query)
+                    data = await cursor.fetchmany(self.max_rows + 1)
             
-            # Get column names
-            if cursor.description:
-                columns = [desc[0] for desc in cursor.description]
-            else:
-                columns = []
-            
-            # Fetch all results
-            rows = cursor.fetchall()
-            
-            # Convert to list of dictionaries
-            data = [dict(zip(columns, row)) for row in rows]
-            
-            cursor.close()
+            truncated = len(data) > self.max_rows
+            if truncated:
+                del data[self.max_rows:]
             
             execution_time = (time.time() - start_time) * 1000  # Convert to ms
             
-            return_db_connection(conn)
+            logger.info(
+                f"Query executed successfully in {execution_time:.2f}ms. Rows: {len(data)}"
+                f"{' (truncated)' if truncated else ''}"
+            )
             
-            logger.info(f"Query executed successfully in {execution_time:.2f}ms. Rows: {len(data)}")
-            
-            return {
+            result = {
                 "success": True,
                 "data": data,
+                "truncated": truncated,
                 "execution_time_ms": execution_time,
-                "error": None
+                "error": None,
+                "error_code": None
             }
+            await self.result_cache.set(sql_query, result)
+            return result
             
         except Exception as e:
-            if conn:
-                return_db_connection(conn)
-            
             execution_time = (time.time() - start_time) * 1000
             error_msg = str(e)
             
@@ -91,7 +139,9 @@ class QueryExecutor:
             return {
                 "success": False,
                 "data": [],
+                "truncated": False,
                 "execution_time_ms": execution_time,
-                "error": error_msg
+                "error": error_msg,
+                "error_code": None
             }
 
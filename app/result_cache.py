@@ -0,0 +1,84 @@
+"""
+Short-lived cache of query results, backed by Redis
+"""
+
+import os
+import re
+import hashlib
+import logging
+from datetime import date
+from typing import Dict, Any, Optional
+
+from app import serialization
+
+try:
+    from redis import asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Queries whose result depends on the current date/time
+_VOLATILE_RE = re.compile(
+    r'\b(?:CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|LOCALTIME|LOCALTIMESTAMP|NOW)\b',
+    re.IGNORECASE
+)
+
+
+class ResultCache:
+    """Redis-backed cache of successful query results keyed by SQL text"""
+    
+    def __init__(self, redis_url: Optional[str] = None, ttl: Optional[int] = None):
+        """
+        Initialize result cache
+        
+        The cache is disabled when no Redis URL is configured or the redis
+        package is not installed.
+        
+        Args:
+            redis_url: Redis connection URL (default: REDIS_URL env var)
+            ttl: Entry lifetime in seconds (default: RESULT_CACHE_TTL env var or 60)
+        """
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        self.ttl = ttl if ttl is not None else int(os.getenv("RESULT_CACHE_TTL", "60"))
+        self.client = None
+        
+        if not redis_url:
+            logger.info("Result cache disabled: REDIS_URL not set")
+        elif redis is None:
+            logger.warning("Result cache disabled: redis package not installed")
+        else:
+            self.client = redis.Redis.from_url(redis_url)
+            logger.info(f"Result cache enabled with TTL: {self.ttl}s")
+    
+    @property
+    def enabled(self) -> bool:
+        """Whether results are being cached"""
+        return self.client is not None
+    
+    def _key(self, sql_query: str) -> str:
+        """Build the cache key; date-relative queries are also keyed by today's date"""
+        key = f"ask:result:{hashlib.blake2b(sql_query.encode(), digest_size=16).hexdigest()}"
+        if _VOLATILE_RE.search(sql_query):
+            key += f":{date.today().isoformat()}"
+        return key
+    
+    async def get(self, sql_query: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result for sql_query, if any"""
+        if not self.enabled:
+            return None
+        try:
+            blob = await self.client.get(self._key(sql_query))
+        except Exception as e:
+            logger.warning(f"Result cache lookup failed: {str(e)}")
+            return None
+        return serialization.loads(blob) if blob else None
+    
+    async def set(self, sql_query: str, result: Dict[str, Any]):
+        """Store a query result for ttl seconds"""
+        if not self.enabled:
+            return
+        try:
+            await self.client.setex(self._key(sql_query), self.ttl, serialization.dumps(result))
+        except Exception as e:
+            logger.warning(f"Result cache store failed: {str(e)}")
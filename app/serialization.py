@@ -0,0 +1,50 @@
+"""
+Fast JSON serialization for query results
+"""
+
+from datetime import timedelta
+from typing import Any
+
+import orjson
+
+
+def _iso_duration(value: timedelta) -> str:
+    """Render a timedelta as an ISO 8601 duration, the way Pydantic does ("P1DT2H")"""
+    sign = "-" if value < timedelta(0) else ""
+    value = abs(value)
+    years, days = divmod(value.days, 365)
+    hours, remainder = divmod(value.seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    
+    date_part = (f"{years}Y" if years else "") + (f"{days}D" if days else "")
+    time_part = (f"{hours}H" if hours else "") + (f"{minutes}M" if minutes else "")
+    if value.microseconds:
+        time_part += f"{seconds}.{value.microseconds:06d}".rstrip("0") + "S"
+    elif seconds:
+        time_part += f"{seconds}S"
+    
+    if not date_part and not time_part:
+        return "PT0S"
+    return f"{sign}P{date_part}" + (f"T{time_part}" if time_part else "")
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, timedelta):
+        return _iso_duration(obj)
+    return str(obj)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize to JSON bytes with orjson.
+    
+    Types orjson does not handle natively fall back to the same wire format
+    Pydantic uses in responses: ISO 8601 durations for timedelta (Postgres
+    intervals) and str() for everything else (Decimal, ...).
+    """
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def loads(data: bytes) -> Any:
+    """Deserialize JSON bytes with orjson"""
+    return orjson.loads(data)
@@ -5,13 +5,17 @@ Main API server for handling natural language queries and SQL generation.
 
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import logging
-import asyncio
+import sys
 from contextlib import asynccontextmanager
+from functools import lru_cache
+from openai import NotFoundError
 
-from app.database import get_db_connection, validate_sql_query
+from app import serialization
+from app.database import init_db_pool, close_db_pool, validate_sql_query, apply_row_limit
 from app.llm_service import LLMService
 from app.query_executor import QueryExecutor
 
@@ -22,33 +26,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize services
-llm_service = None
-query_executor = None
+
+# Shared services, injected into handlers with Depends
+@lru_cache
+def get_llm_service() -> LLMService:
+    """Shared LLMService instance (FastAPI dependency)"""
+    return LLMService()
+
+
+@lru_cache
+def get_query_executor() -> QueryExecutor:
+    """Shared QueryExecutor instance (FastAPI dependency)"""
+    return QueryExecutor()
+
+
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson, including Decimal and other non-native types"""
+    
+    def render(self, content: Any) -> bytes:
+        return serialization.dumps(content)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize and cleanup resources"""
-    global llm_service, query_executor
-    
-    # Startup
+    # Startup: build the shared services now so misconfiguration fails fast
     logger.info("Initializing Lab Intelligence Chatbot services...")
-    llm_service = LLMService()
-    query_executor = QueryExecutor()
+    get_llm_service()
+    get_query_executor()
+    
+    # Open the pool up front so the first requests don't pay the connection handshake
+    try:
+        await init_db_pool(wait=True)
+    except Exception as e:
+        logger.warning(f"Database pool not ready at startup, will keep retrying: {str(e)}")
     logger.info("Services initialized successfully")
     
     yield
     
     # Shutdown
     logger.info("Shutting down services...")
+    await close_db_pool()
 
 
 app = FastAPI(
     title="Lab Intelligence Chatbot API",
     description="Natural language to SQL API for lab data queries",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=OrjsonResponse
 )
 
 # CORS middleware
@@ -65,6 +91,7 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     question: str
     user_id: Optional[str] = None
+    batch: bool = False
 
 
 class QueryResponse(BaseModel):
@@ -74,6 +101,30 @@ class QueryResponse(BaseModel):
     row_count: int
     execution_time_ms: float
     success: bool
+    truncated: bool = False
+
+
+class BatchSubmitResponse(BaseModel):
+    batch_id: str
+    status: str
+
+
+class BatchQueryResult(BaseModel):
+    question: str
+    answer: str
+    sql_query: Optional[str] = None
+    data: List[Dict[str, Any]] = []
+    row_count: int = 0
+    execution_time_ms: float = 0
+    success: bool
+    truncated: bool = False
+    error: Optional[str] = None
+
+
+class BatchResultResponse(BaseModel):
+    batch_id: str
+    status: str
+    results: List[BatchQueryResult]
 
 
 class SchemaResponse(BaseModel):
@@ -153,17 +204,29 @@ async def get_schema():
     return SchemaResponse(schema=schema)
 
 
-@app.post("/ask", response_model=QueryResponse)
-async def ask_question(request: QueryRequest):
+@app.post("/ask", response_model=Union[QueryResponse, BatchSubmitResponse])
+async def ask_question(
+    request: QueryRequest,
+    fresh: bool = False,
+    llm_service: LLMService = Depends(get_llm_service),
+    query_executor: QueryExecutor = Depends(get_query_executor)
+):
     """
     Main endpoint for natural language queries.
     Converts natural language to SQL, validates, executes, and returns results.
+    Pass ?fresh=1 to bypass the short-lived result cache.
+    With batch=true the question is queued on the OpenAI Batch API instead and
+    a batch ID is returned for polling via GET /ask/batch/{batch_id}.
     """
     try:
         logger.info(f"Received question: {request.question[:100]}...")
         
-        # Step 1: Generate SQL from natural language (sync operation)
-        sql_query = await asyncio.to_thread(llm_service.generate_sql, request.question)
+        if request.batch:
+            batch_id = await llm_service.submit_batch([request.question])
+            return BatchSubmitResponse(batch_id=batch_id, status="submitted")
+        
+        # Step 1: Generate SQL from natural language
+        sql_query = await llm_service.generate_sql(request.question)
         
         if not sql_query:
             raise HTTPException(
@@ -182,12 +245,16 @@ async def ask_question(request: QueryRequest):
                 detail=f"Invalid SQL query: {validation_result['error']}"
             )
         
-        # Step 3: Execute query (sync operation, FastAPI will handle it)
-        execution_result = await asyncio.to_thread(query_executor.execute_query, sql_query)
+        # Bound result size before execution
+        sql_query = apply_row_limit(sql_query, validation_result["statement"], query_executor.max_rows)
+        
+        # Step 3: Execute query
+        execution_result = await query_executor.execute_query(sql_query, use_cache=not fresh)
         
         if not execution_result["success"]:
+            # Queries rejected by the cost check are the user's to narrow down
             raise HTTPException(
-                status_code=500,
+                status_code=400 if execution_result.get("error_code") == "query_too_expensive" else 500,
                 detail=f"Query execution failed: {execution_result.get('error', 'Unknown error')}"
             )
         
@@ -198,17 +265,20 @@ async def ask_question(request: QueryRequest):
         # Generate natural language answer
         answer = llm_service.format_answer(request.question, sql_query, data, row_count)
         
-        response = QueryResponse(
-            answer=answer,
-            sql_query=sql_query,
-            data=data,
-            row_count=row_count,
-            execution_time_ms=execution_result.get("execution_time_ms", 0),
-            success=True
-        )
-        
         logger.info(f"Query completed successfully. Rows returned: {row_count}")
-        return response
+        
+        # Return the response directly so the (potentially large) data rows skip
+        # Pydantic validation and are encoded once by orjson; QueryResponse
+        # still documents the shape
+        return OrjsonResponse(content={
+            "answer": answer,
+            "sql_query": sql_query,
+            "data": data,
+            "row_count": row_count,
+            "execution_time_ms": execution_result.get("execution_time_ms", 0),
+            "success": True,
+            "truncated": execution_result.get("truncated", False)
+        })
         
     except HTTPException:
         raise
@@ -220,7 +290,89 @@ async def ask_question(request: QueryRequest):
         )
 
 
+@app.get("/ask/batch/{batch_id}", response_model=BatchResultResponse)
+async def get_batch_results(
+    batch_id: str,
+    llm_service: LLMService = Depends(get_llm_service),
+    query_executor: QueryExecutor = Depends(get_query_executor)
+):
+    """
+    Poll a batch submitted via /ask with batch=true.
+    Once the batch completes, each generated query is validated, executed and
+    returned alongside its answer.
+    """
+    try:
+        batch = await llm_service.get_batch_results(batch_id)
+    except NotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch not found: {batch_id}")
+    except Exception as e:
+        logger.error(f"Error polling batch {batch_id}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+    
+    results = []
+    for item in batch["items"]:
+        question = item["question"]
+        sql_query = item["sql_query"]
+        
+        if not sql_query:
+            results.append(BatchQueryResult(
+                question=question,
+                answer="Unable to generate SQL query. Please rephrase your question.",
+                success=False,
+                error=item["error"]
+            ))
+            continue
+        
+        validation_result = validate_sql_query(sql_query)
+        if not validation_result["is_valid"]:
+            logger.warning(f"SQL validation failed: {validation_result['error']}")
+            results.append(BatchQueryResult(
+                question=question,
+                answer="The generated query was rejected.",
+                sql_query=sql_query,
+                success=False,
+                error=f"Invalid SQL query: {validation_result['error']}"
+            ))
+            continue
+        
+        sql_query = apply_row_limit(sql_query, validation_result["statement"], query_executor.max_rows)
+        execution_result = await query_executor.execute_query(sql_query)
+        if not execution_result["success"]:
+            results.append(BatchQueryResult(
+                question=question,
+                answer="The query failed to execute.",
+                sql_query=sql_query,
+                execution_time_ms=execution_result.get("execution_time_ms", 0),
+                success=False,
+                error=f"Query execution failed: {execution_result.get('error', 'Unknown error')}"
+            ))
+            continue
+        
+        data = execution_result["data"]
+        row_count = len(data)
+        results.append(BatchQueryResult(
+            question=question,
+            answer=llm_service.format_answer(question, sql_query, data, row_count),
+            sql_query=sql_query,
+            data=data,
+            row_count=row_count,
+            execution_time_ms=execution_result.get("execution_time_ms", 0),
+            success=True,
+            truncated=execution_result.get("truncated", False)
+        ))
+    
+    return BatchResultResponse(batch_id=batch_id, status=batch["status"], results=results)
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    
+    # psycopg's async connections need a selector event loop on Windows, where
+    # uvicorn otherwise builds a ProactorEventLoop
+    loop = "asyncio:SelectorEventLoop" if sys.platform == "win32" else "auto"
+    
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop)
 
@@ -0,0 +1,79 @@
+"""
+Regression tests for SQL validation
+"""
+
+import pytest
+
+from app.database import validate_sql_query, apply_row_limit
+
+
+@pytest.mark.parametrize("sql_query", [
+    "SELECT 1;",
+    "SELECT t.test_name FROM test t WHERE t.is_abnormal = TRUE;",
+    "SELECT COUNT(*) FROM report_details WHERE DATE(bill_date) = CURRENT_DATE - 1;",
+    "SELECT a FROM test UNION SELECT b FROM parameters;",
+    "SELECT parameter_name FROM parameters WHERE impression = 'a--b';",
+])
+def test_accepts_read_only_queries(sql_query):
+    assert validate_sql_query(sql_query)["is_valid"]
+
+
+@pytest.mark.parametrize("sql_query", [
+    "SELECT rolname, rolpassword FROM pg_authid;",
+    "SELECT * FROM pg_catalog.pg_shadow;",
+    "SELECT usename, query FROM pg_stat_activity;",
+    "SELECT name, setting FROM pg_settings;",
+    "SELECT * FROM PG_CATALOG.PG_ROLES;",
+    "SELECT table_name FROM information_schema.tables;",
+    "SELECT * FROM test t JOIN pg_user u ON u.usesysid = t.ng_test_id;",
+    "SELECT * FROM test WHERE ng_test_id IN (SELECT oid FROM pg_class);",
+])
+def test_rejects_system_catalog_reads(sql_query):
+    result = validate_sql_query(sql_query)
+    assert not result["is_valid"]
+    assert "system table" in result["error"]
+
+
+@pytest.mark.parametrize("sql_query", [
+    "",
+    "DELETE FROM test;",
+    "SELECT 1; DROP TABLE test;",
+    "SELECT 1 -- comment",
+    "SELECT pg_sleep(10);",
+    "SELECT current_setting('data_directory');",
+    "SELECT * FROM test FOR UPDATE;",
+    "SELECT * INTO backup FROM test;",
+    "WITH d AS (DELETE FROM test RETURNING *) SELECT * FROM d;",
+])
+def test_rejects_unsafe_queries(sql_query):
+    assert not validate_sql_query(sql_query)["is_valid"]
+
+
+@pytest.mark.parametrize("sql_query, expected", [
+    # No limit: one is added (max_rows + 1 so truncation can be detected)
+    ("SELECT a FROM test;", "SELECT a FROM test LIMIT 11"),
+    ("SELECT a FROM test OFFSET 5;", "SELECT a FROM test LIMIT 11 OFFSET 5"),
+    # Literal limits within the cap are left untouched
+    ("SELECT a FROM test LIMIT 5;", "SELECT a FROM test LIMIT 5;"),
+    ("SELECT a FROM test LIMIT 11;", "SELECT a FROM test LIMIT 11;"),
+    ("SELECT a FROM test FETCH FIRST 3 ROWS ONLY;", "SELECT a FROM test FETCH FIRST 3 ROWS ONLY;"),
+    (
+        "SELECT * FROM test ORDER BY ng_test_id DESC FETCH FIRST ROW ONLY;",
+        "SELECT * FROM test ORDER BY ng_test_id DESC FETCH FIRST ROW ONLY;",
+    ),
+    # Literal limits above the cap are lowered
+    ("SELECT a FROM test LIMIT 5000;", "SELECT a FROM test LIMIT 11"),
+    ("SELECT a FROM test LIMIT 5000 OFFSET 10;", "SELECT a FROM test LIMIT 11 OFFSET 10"),
+    ("SELECT a FROM test FETCH FIRST 5000 ROWS ONLY;", "SELECT a FROM test LIMIT 11"),
+    ("SELECT a FROM test LIMIT ALL;", "SELECT * FROM (SELECT a FROM test LIMIT ALL) AS q LIMIT 11"),
+    # Expression limits are kept and the query is wrapped
+    ("SELECT a FROM test LIMIT (5);", "SELECT * FROM (SELECT a FROM test LIMIT (5)) AS q LIMIT 11"),
+    ("SELECT a FROM test LIMIT 10 + 5;", "SELECT * FROM (SELECT a FROM test LIMIT 10 + 5) AS q LIMIT 11"),
+    (
+        "SELECT a FROM test LIMIT CAST('5' AS INT);",
+        "SELECT * FROM (SELECT a FROM test LIMIT CAST('5' AS INT)) AS q LIMIT 11",
+    ),
+])
+def test_apply_row_limit(sql_query, expected):
+    statement = validate_sql_query(sql_query)["statement"]
+    assert apply_row_limit(sql_query, statement, 10) == expected
@@ -0,0 +1,109 @@
+"""
+Regression tests for LLM output post-processing
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.llm_service import LLMService
+
+
+@pytest.fixture
+def llm_service(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.delenv("OPENAI_PROMPT_ID", raising=False)
+    return LLMService()
+
+
+@pytest.mark.parametrize("content, expected", [
+    ("SELECT 1", "SELECT 1;"),
+    ("```sql\nSELECT 1\n```", "SELECT 1;"),
+    ("```sql\r\nSELECT 1;\r\n```", "SELECT 1;"),
+    ("```sql SELECT 1;```", "SELECT 1;"),
+    ("```SQL SELECT 1```", "SELECT 1;"),
+    ("  ```postgres\nSELECT 1\n```\n", "SELECT 1;"),
+    ("```\nSELECT 1\n```", "SELECT 1;"),
+    ("```SELECT 1```", "SELECT 1;"),
+    ("```SELECT\n1\n```", "SELECT\n1;"),
+    ("```select\n  t.test_name\nFROM test```", "select\n  t.test_name\nFROM test;"),
+    ("```WITH x AS (SELECT 1)\nSELECT * FROM x```", "WITH x AS (SELECT 1)\nSELECT * FROM x;"),
+])
+def test_extract_sql_strips_markdown_fences(llm_service, content, expected):
+    assert llm_service._extract_sql(content) == expected
+
+
+def test_unpinned_stored_prompt_disables_sql_cache(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("OPENAI_PROMPT_ID", "pmpt_test")
+    monkeypatch.delenv("OPENAI_PROMPT_VERSION", raising=False)
+    service = LLMService()
+    
+    key = service._cache_key("reports today")
+    service._cache_put(key, "SELECT 1;")
+    assert service._cache_get(key) is None
+
+
+def test_pinned_stored_prompt_keys_cache_on_version(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("OPENAI_PROMPT_ID", "pmpt_test")
+    monkeypatch.setenv("OPENAI_PROMPT_VERSION", "3")
+    service = LLMService()
+    
+    key = service._cache_key("reports today")
+    service._cache_put(key, "SELECT 1;")
+    assert key[1] == "pmpt_test:3"
+    assert service._cache_get(key) == "SELECT 1;"
+
+
+def test_extract_sql_keeps_keyword_on_fence_line(llm_service):
+    content = "```WITH x AS (SELECT 1)\nSELECT * FROM x```"
+    assert llm_service._extract_sql(content) == "WITH x AS (SELECT 1)\nSELECT * FROM x;"
+
+
+def test_get_batch_results_tolerates_null_content_and_foreign_prompts(llm_service):
+    def request(custom_id, prompt):
+        return json.dumps({
+            "custom_id": custom_id,
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": llm_service.model_name,
+                "messages": [
+                    {"role": "system", "content": llm_service._system_prompt},
+                    {"role": "user", "content": prompt}
+                ]
+            }
+        })
+    
+    def output(custom_id, content):
+        return json.dumps({
+            "custom_id": custom_id,
+            "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}
+        })
+    
+    files = {
+        "in": "\n".join([
+            request("q-0", "Question: reports today\n\nGenerate the SQL query:"),
+            request("q-1", "Question: refused\n\nGenerate the SQL query:"),
+            request("q-2", "not generated by submit_batch"),
+        ]),
+        "out": "\n".join([output("q-0", "SELECT 1"), output("q-1", None), output("q-2", "SELECT 2")]),
+    }
+    
+    class FakeFiles:
+        async def content(self, file_id):
+            return SimpleNamespace(text=files[file_id])
+    
+    class FakeBatches:
+        async def retrieve(self, batch_id):
+            return SimpleNamespace(status="completed", input_file_id="in", output_file_id="out")
+    
+    llm_service.client = SimpleNamespace(files=FakeFiles(), batches=FakeBatches())
+    result = asyncio.run(llm_service.get_batch_results("batch_test"))
+    
+    assert result["items"] == [
+        {"question": "reports today", "sql_query": "SELECT 1;", "error": None},
+        {"question": "refused", "sql_query": None, "error": "SQL generation failed in batch"},
+    ]
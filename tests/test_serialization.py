@@ -0,0 +1,25 @@
+"""
+Regression tests for result serialization
+"""
+
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from app.serialization import dumps, loads
+
+
+@pytest.mark.parametrize("value,expected", [
+    (timedelta(days=1, hours=2), "P1DT2H"),
+    (timedelta(0), "PT0S"),
+    (timedelta(seconds=1.5), "PT1.5S"),
+    (timedelta(hours=-1), "-PT1H"),
+    (timedelta(days=400, seconds=59), "P1Y35DT59S"),
+])
+def test_dumps_renders_intervals_as_iso_durations(value, expected):
+    assert loads(dumps({"duration": value})) == {"duration": expected}
+
+
+def test_dumps_renders_decimals_as_strings():
+    assert loads(dumps([Decimal("1.50")])) == ["1.50"]